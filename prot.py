@@ -1,11 +1,20 @@
 import streamlit as st
 import pandas as pd
-import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import httpx
+import orjson
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import py3Dmol
 import streamlit.components.v1 as components
 import io
+import os
+import tempfile
 import zipfile
+from pathlib import Path
 
 # --- Page Configuration & Theming ---
 st.set_page_config(
@@ -16,8 +25,7 @@ st.set_page_config(
 )
 
 # -- Inject Custom CSS for Pro-Level UI --
-st.markdown(
-    """
+_CSS = """
     <style>
     .reportview-container, .main {
       background: linear-gradient(180deg, #ffffff 0%, #f9f9f9 100%);
@@ -59,117 +67,341 @@ st.markdown(
       height: 3em;
     }
     </style>
-    """,
-    unsafe_allow_html=True
-)
+    """
+
+@st.cache_resource
+def _inject_css():
+    st.markdown(_CSS, unsafe_allow_html=True)
+
+_inject_css()
+
+# --- Shared HTTP Client ---
+_HTTP_HEADERS = {"Accept": "application/json", "Accept-Encoding": "gzip, br"}
+_HTTP_LIMITS = httpx.Limits(max_connections=16, max_keepalive_connections=16)
+
+@st.cache_resource
+def get_client():
+    transport = httpx.HTTPTransport(http2=True, limits=_HTTP_LIMITS, retries=3)
+    return httpx.Client(transport=transport, headers=_HTTP_HEADERS, timeout=10)
+
+# Transport retries only cover connection errors; transient 5xx answers are retried here
+_RETRY_STATUSES = {500, 502, 503, 504}
+_RETRY_ATTEMPTS = 3
+_RETRY_BACKOFF = 0.3
+
+def _send(method, url, **kwargs):
+    client = get_client()
+    r = client.request(method, url, **kwargs)
+    for attempt in range(_RETRY_ATTEMPTS):
+        if r.status_code not in _RETRY_STATUSES:
+            break
+        time.sleep(_RETRY_BACKOFF * 2 ** attempt)
+        r = client.request(method, url, **kwargs)
+    return r
+
+async def _send_async(client, method, url, **kwargs):
+    r = await client.request(method, url, **kwargs)
+    for attempt in range(_RETRY_ATTEMPTS):
+        if r.status_code not in _RETRY_STATUSES:
+            break
+        await asyncio.sleep(_RETRY_BACKOFF * 2 ** attempt)
+        r = await client.request(method, url, **kwargs)
+    return r
+
+_PDB_CACHE_DIR = Path(tempfile.gettempdir()) / "protein-structure-finder" / "pdb"
+_PDB_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+def _write_atomic(path, text):
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(text)
+    os.replace(tmp, path)
+
+def _prune_pdb_cache():
+    # Drop least recently used files (by mtime) once the store grows past its cap
+    entries = []
+    for path in _PDB_CACHE_DIR.glob("*.pdb"):
+        try:
+            info = path.stat()
+        except OSError:
+            continue
+        entries.append((info.st_mtime, info.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= _PDB_CACHE_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        path.with_suffix(".etag").unlink(missing_ok=True)
+        total -= size
+
+@st.cache_data(ttl=86400, max_entries=256, show_spinner=False)
+def fetch_pdb_text(pdb_id):
+    # Revalidate against the on-disk copy with If-None-Match so unchanged files come back as 304
+    url = f"https://files.rcsb.org/download/{pdb_id}.pdb"
+    pdb_path = _PDB_CACHE_DIR / f"{pdb_id}.pdb"
+    etag_path = _PDB_CACHE_DIR / f"{pdb_id}.etag"
+    try:
+        headers = {"If-None-Match": etag_path.read_text()} if pdb_path.exists() else {}
+    except OSError:
+        headers = {}
+    r = _send("GET", url, headers=headers, timeout=30)
+    if r.status_code == 304:
+        try:
+            pdb_txt = pdb_path.read_text()
+            os.utime(pdb_path)
+            return pdb_txt
+        except OSError:
+            # The stored copy vanished after revalidation; fetch it again unconditionally
+            r = _send("GET", url, timeout=30)
+    # Raise so error pages never end up in the cache, the ZIPs or the viewer
+    r.raise_for_status()
+    etag = r.headers.get("ETag")
+    if etag:
+        try:
+            _PDB_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            _write_atomic(pdb_path, r.text)
+            _write_atomic(etag_path, etag)
+            _prune_pdb_cache()
+        except OSError:
+            pass
+    return r.text
 
 # --- Hybrid Search Function ---
-@st.cache_data(show_spinner=False)
-def search_entries(query):
-    def precise_query():
-        url = "https://search.rcsb.org/rcsbsearch/v2/query"
-        payload = {
-            "query": {
-                "type": "group",
-                "logical_operator": "or",
-                "nodes": [
-                    {
-                        "type": "terminal",
-                        "service": "text",
-                        "parameters": {
-                            "attribute": "struct.title",
-                            "operator": "contains_phrase",
-                            "value": query
-                        }
-                    },
-                    {
-                        "type": "terminal",
-                        "service": "text",
-                        "parameters": {
-                            "attribute": "rcsb_polymer_entity.pdbx_description",
-                            "operator": "contains_words",
-                            "value": query
-                        }
-                    },
-                    {
-                        "type": "terminal",
-                        "service": "text",
-                        "parameters": {
-                            "attribute": "rcsb_entity_source_organism.gene.rcsb_gene_name.value",
-                            "operator": "contains_words",
-                            "value": query.upper()
-                        }
-                    }
-                ]
-            },
-            "return_type": "entry",
-            "request_options": {"return_all_hits": True}
-        }
-        r = requests.post(url, json=payload)
-        return [rec["identifier"] for rec in r.json().get("result_set", [])] if r.ok else []
-
-    def fallback_full_text():
-        url = "https://search.rcsb.org/rcsbsearch/v2/query"
-        payload = {
-            "query": {
-                "type": "terminal",
-                "service": "full_text",
-                "parameters": {"value": query}
-            },
-            "return_type": "entry",
-            "request_options": {"return_all_hits": True}
-        }
-        r = requests.post(url, json=payload)
-        return [rec["identifier"] for rec in r.json().get("result_set", [])] if r.ok else []
-
-    results = precise_query()
-    return results if results else fallback_full_text()
+_METHOD_VALUES = {
+    "X-RAY": ["X-RAY DIFFRACTION"],
+    "ELECTRON MICROSCOPY": ["ELECTRON MICROSCOPY"],
+    "NMR": ["SOLUTION NMR", "SOLID-STATE NMR"]
+}
+
+def _attribute_node(attribute, operator, value):
+    return {
+        "type": "terminal",
+        "service": "text",
+        "parameters": {"attribute": attribute, "operator": operator, "value": value}
+    }
+
+_SEARCH_URL = "https://search.rcsb.org/rcsbsearch/v2/query"
+_SEARCH_OPTIONS = {"return_all_hits": True, "results_verbosity": "compact"}
+_COUNT_OPTIONS = {"return_counts": True}
+
+# Title / description / gene-name OR group; values are filled in per query
+_PRECISE_TEMPLATE = {
+    "type": "group",
+    "logical_operator": "or",
+    "nodes": [
+        _attribute_node("struct.title", "contains_phrase", None),
+        _attribute_node("rcsb_polymer_entity.pdbx_description", "contains_words", None),
+        _attribute_node("rcsb_entity_source_organism.gene.rcsb_gene_name.value", "contains_words", None)
+    ]
+}
+
+_FULL_TEXT_TEMPLATE = {"type": "terminal", "service": "full_text", "parameters": {"value": None}}
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def search_entries(query, only_human=False, monomer_only=False, max_res=None, method_filter="Any"):
+    filter_nodes = []
+    if max_res is not None:
+        filter_nodes.append(_attribute_node("rcsb_entry_info.resolution_combined", "less_or_equal", max_res))
+    if method_filter in _METHOD_VALUES:
+        filter_nodes.append(_attribute_node("exptl.method", "in", _METHOD_VALUES[method_filter]))
+    if only_human:
+        filter_nodes.append(_attribute_node("rcsb_entity_source_organism.scientific_name", "exact_match", "Homo sapiens"))
+    if monomer_only:
+        filter_nodes.append(_attribute_node("rcsb_entry_info.deposited_polymer_entity_instance_count", "equals", 1))
+
+    def with_filters(node):
+        if not filter_nodes:
+            return node
+        return {"type": "group", "logical_operator": "and", "nodes": [node] + filter_nodes}
+
+    def run(node, options):
+        r = _send("POST", _SEARCH_URL, json={"query": node, "return_type": "entry", "request_options": options})
+        # Raise so a failed search is reported instead of cached as "no hits"
+        r.raise_for_status()
+        # RCSB answers 204 No Content when nothing matches
+        if r.status_code == 204:
+            return {}
+        return orjson.loads(r.content)
+
+    values = (query, query, query.upper())
+    text_query = {**_PRECISE_TEMPLATE, "nodes": [
+        {**node, "parameters": {**node["parameters"], "value": value}}
+        for node, value in zip(_PRECISE_TEMPLATE["nodes"], values)
+    ]}
+    def search(node):
+        # Returns (filtered ids, unfiltered total) in a single round trip
+        if not filter_nodes:
+            ids = run(node, _SEARCH_OPTIONS).get("result_set", [])
+            return ids, len(ids)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            count = executor.submit(run, node, _COUNT_OPTIONS)
+            hits = executor.submit(run, with_filters(node), _SEARCH_OPTIONS)
+            return hits.result().get("result_set", []), count.result().get("total_count", 0)
+
+    # Fall back on the unfiltered text match, so hits that all fail the filters don't trigger full-text search
+    entries, total = search(text_query)
+    if not total:
+        entries, total = search({**_FULL_TEXT_TEMPLATE, "parameters": {"value": query}})
+    return entries, total
 
 # --- Metadata Fetcher ---
-@st.cache_data(show_spinner=False)
-def fetch_all_metadata(ids, max_threads):
-    def fetch_one(eid):
-        try:
-            e = requests.get(f"https://data.rcsb.org/rest/v1/core/entry/{eid}", timeout=10)
-            ed = e.json()
-            method = ed.get("exptl", [{}])[0].get("method", "Unknown")
-            resolution = ed.get("rcsb_entry_info", {}).get("resolution_combined", [None])[0]
-            title = ed.get("struct", {}).get("title", "No Title")
-            orgs, chains = set(), []
-            for ent in ed.get("rcsb_entry_container_identifiers", {}).get("polymer_entity_ids", []):
-                pe = requests.get(f"https://data.rcsb.org/rest/v1/core/polymer_entity/{eid}/{ent}", timeout=10)
-                pdj = pe.json()
-                src = pdj.get("rcsb_entity_source_organism", [])
-                if src:
-                    orgs.add(src[0].get("scientific_name", "Unknown"))
-                chains += pdj.get("rcsb_polymer_entity_container_identifiers", {}).get("auth_asym_ids", [])
-            return {
-                "PDB ID": eid,
-                "Title": title,
-                "Method": method,
-                "Resolution (Å)": resolution,
-                "Organism": ", ".join(sorted(orgs)) or "Unknown",
-                "Chain Count": len(set(chains))
-            }
-        except:
-            return None
+_GRAPHQL_URL = "https://data.rcsb.org/graphql"
+_GRAPHQL_BATCH = 50
+_METADATA_QUERY = """
+query($ids: [String!]!) {
+  entries(entry_ids: $ids) {
+    rcsb_id
+    struct { title }
+    exptl { method }
+    rcsb_entry_info { resolution_combined }
+    polymer_entities {
+      rcsb_entity_source_organism { scientific_name }
+      rcsb_polymer_entity_container_identifiers { auth_asym_ids }
+    }
+  }
+}
+"""
+
+async def _fetch_metadata_batches(ids, max_concurrency):
+    limit = asyncio.Semaphore(max_concurrency)
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=_HTTP_LIMITS, retries=3)
+
+    async with httpx.AsyncClient(transport=transport, headers=_HTTP_HEADERS, timeout=30) as client:
+        async def fetch_batch(batch):
+            try:
+                async with limit:
+                    r = await _send_async(client, "POST", _GRAPHQL_URL, json={"query": _METADATA_QUERY, "variables": {"ids": batch}})
+                r.raise_for_status()
+                entries = (orjson.loads(r.content).get("data") or {}).get("entries") or []
+            except Exception:
+                return []
+            rows = []
+            for ed in entries:
+                if not ed:
+                    continue
+                method = (ed.get("exptl") or [{}])[0].get("method", "Unknown")
+                resolution = ((ed.get("rcsb_entry_info") or {}).get("resolution_combined") or [None])[0]
+                title = (ed.get("struct") or {}).get("title", "No Title")
+                orgs, chains = set(), []
+                for pe in ed.get("polymer_entities") or []:
+                    src = pe.get("rcsb_entity_source_organism") or []
+                    if src:
+                        orgs.add(src[0].get("scientific_name", "Unknown"))
+                    chains += (pe.get("rcsb_polymer_entity_container_identifiers") or {}).get("auth_asym_ids") or []
+                rows.append({
+                    "PDB ID": ed["rcsb_id"],
+                    "Title": title,
+                    "Method": method,
+                    "Resolution (Å)": resolution,
+                    "Organism": ", ".join(sorted(orgs)) or "Unknown",
+                    "Chain Count": len(set(chains))
+                })
+            return rows
+
+        return await asyncio.gather(*[
+            fetch_batch(ids[i:i + _GRAPHQL_BATCH]) for i in range(0, len(ids), _GRAPHQL_BATCH)
+        ])
+
+_ENTRY_CACHE_SIZE = 4096
+_METADATA_TTL = 3600
+
+@st.cache_resource
+def _entry_row_cache():
+    # (fetched_at, row) pairs from earlier searches, shared across reruns and sessions
+    return OrderedDict(), threading.Lock()
+
+@st.cache_data(ttl=_METADATA_TTL, max_entries=128, show_spinner=False)
+def fetch_all_metadata(ids, max_concurrency):
+    cache, lock = _entry_row_cache()
     rows = []
-    with ThreadPoolExecutor(max_workers=max_threads) as executor:
-        futures = [executor.submit(fetch_one, eid) for eid in ids]
-        for future in as_completed(futures):
-            md = future.result()
-            if md:
-                rows.append(md)
-    return pd.DataFrame(rows)
+    now = time.monotonic()
+    with lock:
+        for eid in dict.fromkeys(ids):
+            if eid not in cache:
+                continue
+            fetched_at, md = cache[eid]
+            if now - fetched_at > _METADATA_TTL:
+                del cache[eid]
+                continue
+            cache.move_to_end(eid)
+            rows.append(md)
+        missing = [eid for eid in dict.fromkeys(ids) if eid not in cache]
+
+    fetched = [md for batch in asyncio.run(_fetch_metadata_batches(missing, max_concurrency)) for md in batch]
+    now = time.monotonic()
+    with lock:
+        for md in fetched:
+            cache[md["PDB ID"]] = (now, md)
+        while len(cache) > _ENTRY_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    cols = {"PDB ID": [], "Title": [], "Method": [], "Resolution (Å)": [], "Organism": [], "Chain Count": []}
+    for md in rows + fetched:
+        for col, val in md.items():
+            cols[col].append(val)
+    return pd.DataFrame({
+        "PDB ID": pd.array(cols["PDB ID"], dtype="string"),
+        "Title": pd.array(cols["Title"], dtype="string"),
+        "Method": pd.Categorical(cols["Method"]),
+        "Resolution (Å)": np.array(cols["Resolution (Å)"], dtype="float64"),
+        "Organism": pd.Categorical(cols["Organism"]),
+        "Chain Count": np.array(cols["Chain Count"], dtype="int16")
+    })
 
 # --- 3D Viewer ---
-def view_structure_3d(pdb_id):
-    pdb_txt = requests.get(f"https://files.rcsb.org/download/{pdb_id}.pdb").text
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def _viewer_html(pdb_id):
+    pdb_txt = fetch_pdb_text(pdb_id)
     view = py3Dmol.view(width=900, height=600)
     view.addModel(pdb_txt, "pdb")
     view.setStyle({"cartoon": {"color": "spectrum"}})
     view.zoomTo()
-    return view
+    return view._make_html()
+
+# --- ZIP Builder ---
+class PDBDownloadError(Exception):
+    def __init__(self, pdb_ids):
+        self.pdb_ids = pdb_ids
+        super().__init__(f"Could not download: {', '.join(pdb_ids)}")
+
+def _is_missing(err):
+    # RCSB has no legacy .pdb file for large / mmCIF-only entries; retrying can't help
+    return isinstance(err, httpx.HTTPStatusError) and err.response.status_code == 404
+
+def _fetch_pdb(pdb_id):
+    try:
+        return pdb_id, fetch_pdb_text(pdb_id), None
+    except httpx.HTTPError as err:
+        return pdb_id, None, err
+
+@st.cache_data(ttl=1800, max_entries=8, show_spinner="Building ZIP…")
+def build_zip(pdb_ids, _max_threads):
+    # The leading underscore keeps the thread count out of Streamlit's cache key
+    buf = io.BytesIO()
+    missing, failed = [], []
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zipf, \
+            ThreadPoolExecutor(max_workers=_max_threads) as executor:
+        for pdb_id, pdb_txt, err in executor.map(_fetch_pdb, pdb_ids):
+            if err is not None:
+                (missing if _is_missing(err) else failed).append(pdb_id)
+                continue
+            with zipf.open(f"{pdb_id}.pdb", "w", force_zip64=True) as dst:
+                dst.write(pdb_txt.encode())
+    # Raising on retryable failures keeps an incomplete archive out of the cache;
+    # permanently missing files are skipped and reported instead
+    if failed:
+        raise PDBDownloadError(failed)
+    return buf.getvalue(), tuple(missing)
+
+def zip_download_button(label, pdb_ids, file_name, max_threads):
+    try:
+        data, missing = build_zip(pdb_ids, max_threads)
+    except PDBDownloadError as err:
+        st.error(f"❌ {err}. Please try again.")
+        return
+    if missing:
+        st.info(f"ℹ️ RCSB has no PDB-format file for {', '.join(missing)}; skipped.")
+    if len(missing) < len(pdb_ids):
+        st.download_button(label, data, file_name, "application/zip")
 
 # --- Sidebar Controls ---
 with st.sidebar:
@@ -187,27 +419,33 @@ if search_btn:
     if not query:
         st.warning("⚠️ Please enter a protein or gene name.")
     else:
-        with st.spinner("🔎 Searching RCSB PDB..."):
-            entries = search_entries(query)
-        if not entries:
-            st.error("❌ No entries found for your query.")
+        try:
+            with st.spinner("🔎 Searching RCSB PDB..."):
+                entries, total = search_entries(query, only_human, monomer_only, max_res, method_filter)
+        except httpx.HTTPError:
+            st.error("❌ The RCSB search service is unavailable. Please try again.")
         else:
-            st.success(f"✅ Found {len(entries)} entries. Fetching metadata...")
-            df_all = fetch_all_metadata(entries, threads)
-            df = df_all.copy()
-            if only_human:
-                df = df[df["Organism"].str.contains("Homo sapiens", na=False)]
-            if monomer_only:
-                df = df[df["Chain Count"] == 1]
-            if method_filter != "Any":
-                df = df[df["Method"].str.contains(method_filter, case=False, na=False)]
-            df = df[df["Resolution (Å)"].notnull() & (df["Resolution (Å)"] <= max_res)]
-            if df.empty:
+            if not total:
+                st.error("❌ No entries found for your query.")
+            elif not entries:
                 st.warning("⚠️ No structures matched your filters.")
             else:
-                st.session_state.df = df
-                st.session_state.raw_count = len(entries)
-                st.session_state.filtered_count = len(df)
+                st.success(f"✅ Found {len(entries)} entries. Fetching metadata...")
+                df = fetch_all_metadata(entries, threads)
+                mask = df["Resolution (Å)"].notna() & (df["Resolution (Å)"] <= max_res)
+                if only_human:
+                    mask &= df["Organism"].str.contains("Homo sapiens", regex=False, na=False)
+                if monomer_only:
+                    mask &= df["Chain Count"] == 1
+                if method_filter != "Any":
+                    mask &= df["Method"].str.contains(method_filter, case=False, regex=False, na=False)
+                df = df.loc[mask]
+                if df.empty:
+                    st.warning("⚠️ No structures matched your filters.")
+                else:
+                    st.session_state.df = df
+                    st.session_state.raw_count = total
+                    st.session_state.filtered_count = len(df)
 
 # --- Display Results & Viewer ---
 if "df" in st.session_state:
@@ -234,21 +472,13 @@ if "df" in st.session_state:
             st.markdown("### 🏆 Top 3 X-ray Structures")
             st.table(top3)
 
-            buf_all = io.BytesIO()
-            with zipfile.ZipFile(buf_all, "w") as zipf:
-                for pdb_id in df["PDB ID"]:
-                    pdb_txt = requests.get(f"https://files.rcsb.org/download/{pdb_id}.pdb").text
-                    zipf.writestr(f"{pdb_id}.pdb", pdb_txt)
-            buf_all.seek(0)
-            st.download_button("📥 Download All Filtered PDBs (ZIP)", buf_all, "filtered_structures.zip", "application/zip")
-
-            buf_top = io.BytesIO()
-            with zipfile.ZipFile(buf_top, "w") as zipf:
-                for pdb_id in top3["PDB ID"]:
-                    pdb_txt = requests.get(f"https://files.rcsb.org/download/{pdb_id}.pdb").text
-                    zipf.writestr(f"{pdb_id}.pdb", pdb_txt)
-            buf_top.seek(0)
-            st.download_button("📥 Download Top 3 PDBs (ZIP)", buf_top, "top3_structures.zip", "application/zip")
+            # Only pay for N file downloads once the user actually asks for the bundle
+            all_ids = tuple(sorted(df["PDB ID"]))
+            if st.session_state.get("zip_ids") == all_ids or st.button("📦 Prepare ZIP of All Filtered PDBs"):
+                st.session_state.zip_ids = all_ids
+                zip_download_button("📥 Download All Filtered PDBs (ZIP)", all_ids, "filtered_structures.zip", threads)
+
+            zip_download_button("📥 Download Top 3 PDBs (ZIP)", tuple(sorted(top3["PDB ID"])), "top3_structures.zip", threads)
         else:
             st.warning("⚡ No X-ray structures available in filtered results.")
 
@@ -256,6 +486,20 @@ if "df" in st.session_state:
         st.subheader("🧬 Interactive 3D Viewer")
         choice = st.selectbox("🔬 Select a PDB ID:", df["PDB ID"].tolist())
         if choice:
-            with st.spinner(f"Loading 3D model for {choice}..."):
-                view = view_structure_3d(choice)
-                components.html(view._make_html(), height=700)
+            # Remember the opt-in so unrelated reruns keep the 3D view for this entry
+            if st.session_state.get("viewer_id") == choice or st.button("🧊 Load interactive 3D"):
+                st.session_state.viewer_id = choice
+                with st.spinner(f"Loading 3D model for {choice}..."):
+                    try:
+                        components.html(_viewer_html(choice), height=700)
+                    except httpx.HTTPError as err:
+                        if _is_missing(err):
+                            st.error(f"❌ RCSB has no PDB-format file for {choice}.")
+                        else:
+                            st.error(f"❌ Could not download the structure file for {choice}. Please try again.")
+            else:
+                pid = choice.lower()
+                st.image(
+                    f"https://cdn.rcsb.org/images/structures/{pid[1:3]}/{pid}/{pid}_assembly-1.jpeg",
+                    caption=f"{choice} (biological assembly 1)"
+                )